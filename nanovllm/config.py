@@ -2,6 +2,11 @@ import os
 from dataclasses import dataclass
 from transformers import AutoConfig
 
+# KV Cache 块大小：Sequence 与 BlockManager 共用的唯一常量。必须为 2 的幂，块相关的除法/取模可改写为移位/掩码
+BLOCK_SIZE = 256
+BLOCK_SHIFT = BLOCK_SIZE.bit_length() - 1 # n // BLOCK_SIZE == n >> BLOCK_SHIFT
+BLOCK_MASK = BLOCK_SIZE - 1 # n % BLOCK_SIZE == n & BLOCK_MASK
+
 
 @dataclass
 class Config:
@@ -14,12 +19,12 @@ class Config:
     enforce_eager: bool = False # 是否强制使用 PyTorch Eager 模式执行，设为 True 可用于调试，但会降低性能
     hf_config: AutoConfig | None = None # HuggingFace 的配置对象，在 __post_init__ 中自动加载，无需手动指定
     eos: int = -1 # 结束符 (End of Sentence) 的 Token ID
-    kvcache_block_size: int = 256 # PagedAttention 中每个 KV Cache 块的大小，通常需要是 16 或 32 的倍数
+    kvcache_block_size: int = BLOCK_SIZE # PagedAttention 中每个 KV Cache 块的大小，须与 BLOCK_SIZE 一致
     num_kvcache_blocks: int = -1 # KV Cache 的块总数量，通常根据 gpu_memory_utilization 自动计算，-1 表示自动
 
     def __post_init__(self):
         assert os.path.isdir(self.model) # 确保模型路径存在且为目录
-        assert self.kvcache_block_size % 256 == 0 # 确保 KV Cache 块大小是 256 的倍数（可能是为了对齐或特定硬件优化）
+        assert self.kvcache_block_size == BLOCK_SIZE # Sequence 与 BlockManager 按 BLOCK_SIZE（2 的幂）切分逻辑块，两者必须一致
         assert 1 <= self.tensor_parallel_size <= 8 # 确保张量并行度在合理范围内
         self.hf_config = AutoConfig.from_pretrained(self.model)  # 自动加载 HuggingFace 模型配置
         self.max_model_len = min(self.max_model_len, self.hf_config.max_position_embeddings) # 确保最大模型长度不超过模型本身的限制
@@ -1,68 +1,117 @@
+import sys
+from array import array
 from collections import deque
 import xxhash
-import numpy as np
 
+from nanovllm.config import BLOCK_SIZE, BLOCK_SHIFT, BLOCK_MASK
 from nanovllm.engine.sequence import Sequence
 
 
-class Block:
-
-    def __init__(self, block_id):
-        self.block_id = block_id
-        self.ref_count = 0 # 引用计数
-        self.hash = -1 # 该块所存储 token 序列的哈希值，用于缓存匹配
-        self.token_ids = [] # 该块所存储的 token 序列
-
-    def update(self, hash: int, token_ids: list[int]): # 更新块的哈希值和 token 内容（通常在块填满时调用）
-        self.hash = hash
-        self.token_ids = token_ids
-
-    def reset(self): # 重置块状态，使其变为可用状态
-        self.ref_count = 1
-        self.hash = -1
-        self.token_ids = []
-
-
 class BlockManager: # 负责所有 Block 的生命周期管理（分配、释放、查找）
 
     def __init__(self, num_blocks: int, block_size: int): 
-        self.block_size = block_size
-        self.blocks: list[Block] = [Block(i) for i in range(num_blocks)] # 预先创建 num_blocks 个 Block 对象
-        self.hash_to_block_id: dict[int, int] = dict() # 哈希值到块 ID 的映射，用于快速查找缓存匹配的块
-        self.free_block_ids: deque[int] = deque(range(num_blocks)) # 空闲块队列，用于分配新块（双端队列）
+        assert block_size == BLOCK_SIZE # 块相关计算统一使用 BLOCK_SIZE / BLOCK_SHIFT / BLOCK_MASK 常量
+        # 块元数据按 block_id 索引、按字段分别连续存放（SoA），不再为每个块创建对象
+        # 两者都只做逐块的标量访问（list 索引远快于 numpy 标量索引），因此用 list 而非 numpy 数组
+        self.ref_counts: list[int] = [0] * num_blocks # 每个块的引用计数
+        # 每个块所存储 token 序列的哈希值，用于缓存匹配（64 位 XXH3，碰撞概率可忽略，不保存 token 内容做比对），-1 表示块未满
+        self.hashes: list[int] = [-1] * num_blocks
+        self.hash_to_block_id: dict[int, int] = dict() # 哈希值到块 ID 的映射，用于快速查找缓存匹配的块（只保存仍有效的条目，大小不超过块数）
+        self.free_block_ids: deque[int] = deque(range(num_blocks)) # 空闲块队列，用于分配新块（双端队列，LRU 顺序）
+        self.stale_free_block_ids: dict[int, int] = dict() # 空闲队列中已失效的残留项（块已被缓存命中复用）及其个数，出队时跳过
+        self.num_stale_free_block_ids = 0 # 残留项总数，超过队列长度一半时压缩队列，使队列长度不超过 2 * num_blocks
         self.used_block_ids: set[int] = set() # 已用块集合，用于快速查找已用块
 
-    # 使用 xxhash 算法计算 token 序列的哈希
+    # 使用 xxhash 的 XXH3 算法计算 token 序列的哈希（整块数据一次 C 调用，比 XXH64 吞吐更高）
     # 当 block 满时，才会计算哈希值，用于缓存匹配
     @classmethod
-    def compute_hash(cls, token_ids: list[int], prefix: int = -1): # prefix：前一个 block 的哈希值，用于增量哈希计算
-        h = xxhash.xxh64()
-        if prefix != -1:
-            # 将前一个 Block 的哈希值（整数）转换为 8 字节（64位）的二进制数据，'little' 表示小端字节序
-            h.update(prefix.to_bytes(8, "little"))
-        # 将 token_ids 列表转换为 numpy 数组，再转为紧凑的字节流
-        h.update(np.array(token_ids).tobytes())
-        # 返回一个 64 位的整数作为该 Block 的唯一指纹
-        return h.intdigest()
-
-    # 新序列分配块，返回具体的 block
-    def _allocate_block(self, block_id: int) -> Block: 
-        block = self.blocks[block_id]
-        assert block.ref_count == 0
-        block.reset()
-        self.free_block_ids.remove(block_id)
+    def compute_hash(cls, token_ids: list[int] | array, prefix: int = -1): # prefix：前一个 block 的哈希值，用于增量哈希计算
+        return cls._hash_buffer(cls._pack_tokens(token_ids), prefix)
+
+    @staticmethod
+    def _pack_tokens(token_ids: list[int] | array) -> memoryview: # 将 token_ids 打包为 uint32 数组（词表远小于 2^32，哈希输入减半），按小端字节序排列（与平台无关）
+        if sys.byteorder == "big":
+            buf = array("I", token_ids)
+            buf.byteswap()
+        elif isinstance(token_ids, array) and token_ids.typecode == "I":
+            buf = token_ids # seq.token_ids 的切片本身就是独立的 uint32 数组，直接使用，不再拷贝第二次
+        else:
+            buf = array("I", token_ids)
+        return memoryview(buf)
+
+    @staticmethod
+    def _hash_buffer(data, prefix: int = -1) -> int:
+        # 前一个 Block 的哈希值（64 位无符号整数）作为种子参与计算，不再拼接到数据前面，对切片的哈希无需任何拷贝
+        # 一次性计算，返回一个 64 位的整数作为该 Block 的唯一指纹
+        return xxhash.xxh3_64_intdigest(data, seed=prefix if prefix != -1 else 0)
+
+    @property
+    def num_free_blocks(self) -> int: # 空闲块数量（空闲队列中可能含有残留项，不能直接取其长度）
+        return len(self.hashes) - len(self.used_block_ids)
+
+    # 从空闲队列头部弹出一个真正空闲的块 id，O(1) 摊还。该块即将写入新内容，其缓存的旧内容被淘汰
+    def _pop_free_block_id(self) -> int:
+        while True:
+            block_id = self.free_block_ids.popleft()
+            num_stale = self.stale_free_block_ids.get(block_id, 0)
+            if num_stale == 0:
+                # 若映射仍指向该块，删除其旧哈希，保证映射中的块当前哈希必然与键一致
+                h = self.hashes[block_id]
+                if h != -1 and self.hash_to_block_id.get(h) == block_id:
+                    del self.hash_to_block_id[h]
+                return block_id
+            # 残留项总是早于该块最新一次入队的位置，直接跳过
+            self.num_stale_free_block_ids -= 1
+            if num_stale == 1:
+                del self.stale_free_block_ids[block_id]
+            else:
+                self.stale_free_block_ids[block_id] = num_stale - 1
+
+    # 缓存命中时复用一个仍在空闲队列中的块：不在队列中间做 O(N) 的 remove，而是标记为残留项
+    def _remove_free_block_id(self, block_id: int):
+        self.stale_free_block_ids[block_id] = self.stale_free_block_ids.get(block_id, 0) + 1
+        self.num_stale_free_block_ids += 1
+        if self.num_stale_free_block_ids > len(self.free_block_ids) // 2:
+            self._compact_free_block_ids()
+
+    # 重建空闲队列，丢弃所有残留项并保持其余块的 LRU 顺序。每次压缩至少清掉一半的队列项，摊还 O(1)
+    def _compact_free_block_ids(self):
+        stale_free_block_ids = self.stale_free_block_ids
+        free_block_ids = deque()
+        for block_id in self.free_block_ids:
+            num_stale = stale_free_block_ids.get(block_id, 0)
+            if num_stale == 0:
+                free_block_ids.append(block_id)
+            elif num_stale == 1: # 与出队时一致：每个块靠前的残留项先被跳过
+                del stale_free_block_ids[block_id]
+            else:
+                stale_free_block_ids[block_id] = num_stale - 1
+        assert not stale_free_block_ids
+        self.free_block_ids = free_block_ids
+        self.num_stale_free_block_ids = 0
+
+    # 缓存命中一个已释放、内容尚未被覆盖的块：重新启用，保留其哈希及映射
+    def _revive_block(self, block_id: int):
+        assert self.ref_counts[block_id] == 0
+        self.ref_counts[block_id] = 1
+        self._remove_free_block_id(block_id)
+        self.used_block_ids.add(block_id)
+
+    # 新序列分配块，重置其状态（调用方负责将其移出空闲队列）
+    def _allocate_block(self, block_id: int):
+        assert self.ref_counts[block_id] == 0
+        self.ref_counts[block_id] = 1
+        self.hashes[block_id] = -1
         self.used_block_ids.add(block_id)
-        return self.blocks[block_id]
     
-    # 释放块，将其标记为空闲，返回具体的 block
-    def _deallocate_block(self, block_id: int) -> Block:
-        assert self.blocks[block_id].ref_count == 0
-        self.used_block_ids.remove(block_id)
-        self.free_block_ids.append(block_id)
+    # 释放一批引用计数已归零的块，按给定顺序放回空闲队列
+    def _deallocate_blocks(self, block_ids: list[int]):
+        self.used_block_ids.difference_update(block_ids)
+        self.free_block_ids.extend(block_ids)
 
     # 检查是否有足够的空闲块来分配给序列
     def can_allocate(self, seq: Sequence) -> bool:
-        return len(self.free_block_ids) >= seq.num_blocks
+        return self.num_free_blocks >= seq.num_blocks
 
     # 为序列分配物理内存块（***）
     '''
@@ -81,55 +130,96 @@ class BlockManager: # 负责所有 Block 的生命周期管理（分配、释放
     '''
     def allocate(self, seq: Sequence):
         assert not seq.block_table
-        h = -1
-        cache_miss = False
-        for i in range(seq.num_blocks): # 遍历序列需要的逻辑块数
-            token_ids = seq.block(i) # 获取第 i 个逻辑块的 token 序列
-            h = self.compute_hash(token_ids, h) if len(token_ids) == self.block_size else -1 # 计算当前逻辑块的哈希值（包含前面 block 的 hash）
-            block_id = self.hash_to_block_id.get(h, -1) # 检查 hash_to_block_id 中是否存在对应的物理块。
-            if block_id == -1 or self.blocks[block_id].token_ids != token_ids: 
-                cache_miss = True # 缓存未命中
-            if cache_miss:
-                block_id = self.free_block_ids[0] # 从空闲块队列中获取第一个空闲块
-                block = self._allocate_block(block_id) # 分配新块
-            else:
-                seq.num_cached_tokens += self.block_size # 增加已缓存 token 数量
-                if block_id in self.used_block_ids: # 存在且内容匹配 (token_ids 一致)，则 缓存命中 (Cache Hit) 。
-                    block = self.blocks[block_id]
-                    block.ref_count += 1 # 增加其 ref_count
+        num_blocks = seq.num_blocks # 序列需要的逻辑块数
+        block_hashes = self._hash_full_blocks(seq) # 所有满块的哈希值（包含前面 block 的 hash），未满的块不参与缓存匹配
+        cached_block_ids = self._lookup_cached_blocks(block_hashes)
+        hash_to_block_id = self.hash_to_block_id
+        block_table = seq.block_table
+        # 命中的前缀块：只需批量增加引用计数，不分配新块（整个 prompt 命中时只走这一段）
+        # 命中块的哈希与映射本就是 h -> block_id，无需重写
+        if cached_block_ids:
+            ref_counts = self.ref_counts
+            for block_id in cached_block_ids:
+                if block_id in self.used_block_ids: # 存在且哈希匹配，则 缓存命中 (Cache Hit) 。
+                    ref_counts[block_id] += 1 # 增加其 ref_count
                 else:
-                    block = self._allocate_block(block_id) # 重新分配新块
-            if h != -1:
-                block.update(h, token_ids)
-                self.hash_to_block_id[h] = block_id # 添加映射
-            seq.block_table.append(block_id)
+                    self._revive_block(block_id) # 块已释放但内容未被覆盖，重新启用
+            seq.num_cached_tokens += len(cached_block_ids) << BLOCK_SHIFT # 增加已缓存 token 数量
+            block_table.extend(cached_block_ids)
+        # 第一个未命中之后的块：依次从空闲队列中分配新块
+        for i in range(len(cached_block_ids), num_blocks):
+            block_id = self._pop_free_block_id() # 从空闲块队列中取出第一个空闲块
+            self._allocate_block(block_id) # 分配新块
+            if i < len(block_hashes):
+                h = block_hashes[i]
+                self.hashes[block_id] = h
+                hash_to_block_id[h] = block_id # 添加映射
+            block_table.append(block_id)
+
+    # 按顺序查找满块哈希对应的物理块，返回命中的前缀块 id；遇到第一个未命中即停止（之后的块无法复用前缀）
+    def _lookup_cached_blocks(self, block_hashes: list[int]) -> list[int]:
+        hash_to_block_id = self.hash_to_block_id
+        block_ids = []
+        for h in block_hashes:
+            block_id = hash_to_block_id.get(h, -1) # 检查 hash_to_block_id 中是否存在对应的物理块。
+            # 直接信任哈希；映射中不存在过期条目（块被淘汰时即删除），无需再核对块的当前哈希
+            if block_id == -1:
+                break
+            block_ids.append(block_id)
+        return block_ids
+
+    # 返回序列所有满块的哈希值。哈希值缓存在 seq.block_hashes 中（与物理块无关，抢占后依然有效），只需计算尚未缓存的块
+    def _hash_full_blocks(self, seq: Sequence) -> list[int]:
+        block_hashes = seq.block_hashes
+        start_block = len(block_hashes)
+        num_full_blocks = len(seq) >> BLOCK_SHIFT
+        if start_block < num_full_blocks:
+            # token_ids 的切片即独立的 uint32 缓冲区（只拷贝一次），打包时直接使用
+            token_ids = seq.token_ids[start_block << BLOCK_SHIFT: num_full_blocks << BLOCK_SHIFT]
+            packed = self._pack_tokens(token_ids)
+            h = block_hashes[-1] if block_hashes else -1
+            # 对各块的切片（零拷贝）做链式哈希，从已缓存的最后一个哈希接续
+            for start in range(0, len(token_ids), BLOCK_SIZE):
+                h = self._hash_buffer(packed[start: start + BLOCK_SIZE], h)
+                block_hashes.append(h)
+        return block_hashes
 
     def deallocate(self, seq: Sequence):
+        ref_counts = self.ref_counts
+        freed_block_ids = []
+        # 倒序：后面的块先回到空闲队列、先被复用，前缀块在缓存中保留得更久
         for block_id in reversed(seq.block_table): # 遍历序列持有的所有块，将引用计数减 1
-            block = self.blocks[block_id]
-            block.ref_count -= 1
-            if block.ref_count == 0: # 引用计数为 0 时，释放块
-                self._deallocate_block(block_id) 
+            ref_counts[block_id] -= 1
+            if ref_counts[block_id] == 0: # 引用计数为 0 时，释放块
+                freed_block_ids.append(block_id)
+        if freed_block_ids:
+            self._deallocate_blocks(freed_block_ids)
         seq.num_cached_tokens = 0
         seq.block_table.clear()
 
     def can_append(self, seq: Sequence) -> bool: # 检查是否有足够的空闲块来追加序列
-        return len(self.free_block_ids) >= (len(seq) % self.block_size == 1)
+        # 只有新 token 开启一个新块时才需要空闲块；绝大多数情况下第一个条件即短路返回
+        return (seq.num_tokens & BLOCK_MASK) != 1 or self.num_free_blocks > 0
 
     def may_append(self, seq: Sequence): # 尝试追加序列到最后一个逻辑块
         block_table = seq.block_table
-        last_block = self.blocks[block_table[-1]]
-        if len(seq) % self.block_size == 1:
-            assert last_block.hash != -1
-            block_id = self.free_block_ids[0]
+        last_block_id = block_table[-1]
+        num_tokens = len(seq)
+        r = num_tokens & BLOCK_MASK
+        if r == 1:
+            assert self.hashes[last_block_id] != -1
+            block_id = self._pop_free_block_id()
             self._allocate_block(block_id) # 分配新块
             block_table.append(block_id)
-        elif len(seq) % self.block_size == 0:
-            assert last_block.hash == -1
-            token_ids = seq.block(seq.num_blocks-1)
-            prefix = self.blocks[block_table[-2]].hash if len(block_table) > 1 else -1
+        elif r == 0:
+            assert self.hashes[last_block_id] == -1
+            block_hashes = seq.block_hashes
+            assert len(block_hashes) == (num_tokens >> BLOCK_SHIFT) - 1
+            token_ids = seq.token_ids[num_tokens - BLOCK_SIZE:] # 刚填满的最后一个逻辑块
+            prefix = block_hashes[-1] if block_hashes else -1
             h = self.compute_hash(token_ids, prefix)
-            last_block.update(h, token_ids)
-            self.hash_to_block_id[h] = last_block.block_id
+            block_hashes.append(h)
+            self.hashes[last_block_id] = h
+            self.hash_to_block_id[h] = last_block_id
         else:
-            assert last_block.hash == -1
+            assert self.hashes[last_block_id] == -1
@@ -1,7 +1,9 @@
-from copy import copy
+import struct
+from array import array
 from enum import Enum, auto
 from itertools import count
 
+from nanovllm.config import BLOCK_SHIFT, BLOCK_MASK
 from nanovllm.sampling_params import SamplingParams
 
 
@@ -12,18 +14,23 @@ class SequenceStatus(Enum): # 枚举类，用于标识序列的状态
 
 
 class Sequence:
-    block_size = 256 # 分页内存管理的块大小（每个块存储 256 个 Token）
     counter = count()
+    next_seq_id = counter.__next__ # 预先绑定，创建序列时省去 next() 的查找与分派
+    state_header = struct.Struct("=IIII") # 序列化头部：本机字节序（仅用于同一台机器上的进程间通信）
+    # 属性集合固定（无动态属性），省去每个实例的 __dict__
+    __slots__ = ("seq_id", "status", "token_ids", "last_token", "num_tokens", "num_prompt_tokens", "num_cached_tokens",
+                 "block_table", "block_hashes", "temperature", "max_tokens", "ignore_eos")
 
     def __init__(self, token_ids: list[int], sampling_params = SamplingParams()):
-        self.seq_id = next(Sequence.counter)
+        self.seq_id = Sequence.next_seq_id()
         self.status = SequenceStatus.WAITING
-        self.token_ids = copy(token_ids)
+        self.token_ids = array("I", token_ids) # 连续的 uint32 缓冲区（与块哈希的输入格式一致）：追加 O(1)，打包为字节（用于哈希）只需一次 memcpy
         self.last_token = token_ids[-1]
         self.num_tokens = len(self.token_ids)
         self.num_prompt_tokens = len(token_ids)
         self.num_cached_tokens = 0
         self.block_table = [] # 逻辑块表，用于映射到物理内存块（这里初始化为空，通常由调度器填充）
+        self.block_hashes = [] # 已满逻辑块的哈希值缓存（与物理块无关，抢占释放块表后仍保留，重新分配时无需重算）
         self.temperature = sampling_params.temperature
         self.max_tokens = sampling_params.max_tokens
         self.ignore_eos = sampling_params.ignore_eos
@@ -44,48 +51,58 @@ class Sequence:
 
     @property
     def prompt_token_ids(self): # 获取 prompt token 列表
-        return self.token_ids[:self.num_prompt_tokens]
+        return self.token_ids[:self.num_prompt_tokens].tolist()
 
     @property
     def completion_token_ids(self): # 获取 completion token 列表
-        return self.token_ids[self.num_prompt_tokens:]
+        return self.token_ids[self.num_prompt_tokens:].tolist()
 
     @property
     def num_cached_blocks(self): # 已缓存的块数量 = 已缓存 token 数量 // 块大小
-        return self.num_cached_tokens // self.block_size
+        return self.num_cached_tokens >> BLOCK_SHIFT
 
     @property
     def num_blocks(self): # 当前序列所需的逻辑块总数 = (总 token 数量 + 块大小 - 1) // 块大小
-        return (self.num_tokens + self.block_size - 1) // self.block_size
+        return (self.num_tokens + BLOCK_MASK) >> BLOCK_SHIFT
 
     @property
-    def last_block_num_tokens(self): # 最后一个块的 token 数量 = 总 token 数量 - (总块数量 - 1) * 块大小
-        return self.num_tokens - (self.num_blocks - 1) * self.block_size
+    def last_block_num_tokens(self): # 最后一个块的 token 数量 = 总 token 数量 - (总块数量 - 1) * 块大小，即 (总 token 数量 - 1) % 块大小 + 1
+        return ((self.num_tokens - 1) & BLOCK_MASK) + 1
 
-    def block(self, i): # 第 i 个逻辑块中的所有 Token ID
+    def block(self, i): # 第 i 个逻辑块中的所有 Token ID（array 切片，不返回 memoryview 以免锁住 token_ids 无法追加）
         assert 0 <= i < self.num_blocks
-        return self.token_ids[i*self.block_size: (i+1)*self.block_size]
+        return self.token_ids[i << BLOCK_SHIFT: (i+1) << BLOCK_SHIFT]
 
     def append_token(self, token_id: int): # 推理阶段追加一个 token 到序列中
+        assert 0 <= token_id <= 0xFFFFFFFF # token_ids 以 uint32 存储
         self.token_ids.append(token_id)
         self.last_token = token_id
         self.num_tokens += 1
 
     '''
-    seq 状态序列化，用于保存和恢复序列状态
+    seq 状态序列化，用于保存和恢复序列状态（张量并行时每一步都要发送给其他进程）
+    整个状态打包为单个 bytes：定长头部 (num_tokens, num_prompt_tokens, num_cached_tokens, last_token) + token_ids + block_table
     如果序列已经开始生成（ num_completion_tokens > 0 ），它不会传输完整的 token_ids 列表，而是只传输 last_token
     '''
     def __getstate__(self):
-        return (self.num_tokens, self.num_prompt_tokens, self.num_cached_tokens, self.block_table,
-                self.token_ids if self.num_completion_tokens == 0 else self.last_token)
+        header = Sequence.state_header.pack(self.num_tokens, self.num_prompt_tokens, self.num_cached_tokens, self.last_token)
+        block_table = array("I", self.block_table).tobytes()
+        if self.num_completion_tokens == 0:
+            return b"".join((header, self.token_ids.tobytes(), block_table))
+        return header + block_table
 
     '''
     seq 状态反序列化，用于恢复序列状态
     恢复状态时，如果是生成阶段，它只恢复 last_token
     '''
     def __setstate__(self, state):
-        self.num_tokens, self.num_prompt_tokens, self.num_cached_tokens, self.block_table = state[:-1]
+        header = Sequence.state_header
+        self.num_tokens, self.num_prompt_tokens, self.num_cached_tokens, self.last_token = header.unpack_from(state)
+        state = memoryview(state)[header.size:]
         if self.num_completion_tokens == 0:
-            self.token_ids = state[-1]
-        else:
-            self.last_token = state[-1]
+            self.token_ids = array("I")
+            self.token_ids.frombytes(state[:self.num_tokens * self.token_ids.itemsize])
+            state = state[self.num_tokens * self.token_ids.itemsize:]
+        block_table = array("I")
+        block_table.frombytes(state)
+        self.block_table = block_table.tolist()